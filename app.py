@@ -1,22 +1,38 @@
 import asyncio
+import atexit
+import copy
+import hashlib
+import hmac
 import io
-import json
+import itertools
 import logging
+import math
+import mimetypes
 import os
+import re
 import shutil
 import tempfile
+import threading
+import time
 import zipfile
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Tuple
-from urllib.parse import quote_plus
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Tuple
+from urllib.parse import quote, quote_plus
 
+import orjson
 import requests
-from flask import Flask, abort, jsonify, request, send_file, send_from_directory
+from flask import Flask, Response, abort, jsonify, request, send_file
+from flask.json.provider import JSONProvider
 from PIL import Image
+from requests.adapters import HTTPAdapter
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update, WebAppInfo
 from telegram.error import NetworkError, TimedOut
 from telegram.request import HTTPXRequest
+from urllib3.util.retry import Retry
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 WEBAPP_URL = os.environ.get("WEBAPP_URL")
@@ -25,6 +41,24 @@ ADMIN_CHAT_ID = int(os.environ.get("ADMIN_CHAT_ID", "0")) or None
 ADMIN_PANEL_URL = os.environ.get("ADMIN_PANEL_URL")
 ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
 SAMOPIS_NICK = os.environ.get("SAMOPIS_NICK", "").lstrip("@")
+WEBHOOK_SECRET_BYTES = WEBHOOK_SECRET.encode() if WEBHOOK_SECRET else None
+ADMIN_TOKEN_BYTES = ADMIN_TOKEN.encode() if ADMIN_TOKEN else None
+# Telegram updates are a few KB; anything far larger is not worth parsing.
+WEBHOOK_MAX_BODY = 64 * 1024
+SEND_TIMEOUT = float(os.environ.get("TG_SEND_TIMEOUT", "30"))
+SAVE_DELAY = float(os.environ.get("SAVE_DELAY", "0.5"))
+LOG_LIMIT = 200
+LOG_FILE = "logs.jsonl"
+TG_MESSAGE_LIMIT = 4096
+ZIP_CHUNK_SIZE = 64 * 1024
+# Buffer for copying uploaded and extracted archives; the 16 KiB default means many small reads.
+COPY_BUFFER = 1024 * 1024
+EXTRACT_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+# Already compressed; deflating them again costs CPU for no size gain.
+ZIP_STORED_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp"}
+# Internal nginx location aliased to data/, e.g. /internal/media/; unset serves media from Python.
+MEDIA_ACCEL_PREFIX = os.environ.get("MEDIA_ACCEL_PREFIX", "").rstrip("/")
+MEDIA_MAX_AGE = 86400
 
 if not BOT_TOKEN or not WEBAPP_URL:
     raise RuntimeError("BOT_TOKEN and WEBAPP_URL are required")
@@ -37,45 +71,205 @@ request_client = HTTPXRequest(
     pool_timeout=float(os.environ.get("TG_POOL_TIMEOUT", "10")),
 )
 
+# Carts are keyed by int user/product ids; orjson rejects non-str keys without this flag.
+JSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+# orjson only encodes signed 64-bit ints, so client ints are checked against this before they reach state.
+INT64_MIN, INT64_MAX = -(2**63), 2**63 - 1
+MAX_CART_QTY = 1000
+
+
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, option=JSON_OPTIONS).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=JSON_OPTIONS), mimetype="application/json")
+
+
 app = Flask(__name__, static_folder="static", static_url_path="/static")
+app.json = OrjsonProvider(app)
+# Behind Apache/lighttpd, send_file answers with an X-Sendfile header and the server sends the bytes.
+app.config["USE_X_SENDFILE"] = bool(os.environ.get("USE_X_SENDFILE"))
 bot = Bot(token=BOT_TOKEN, request=request_client)
 
+# One long-lived event loop for all Telegram I/O, so the HTTPX pool is reused between calls.
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, name="telegram-loop", daemon=True).start()
+
 DATA_DIR = Path("data")
 IMAGES_DIR = DATA_DIR / "images"
 THUMBS_DIR = DATA_DIR / "thumbs"
-for d in (DATA_DIR, IMAGES_DIR, THUMBS_DIR):
+# One file per user, so a cart change rewrites only that user's cart.
+CARTS_DIR = DATA_DIR / "carts"
+for d in (DATA_DIR, IMAGES_DIR, THUMBS_DIR, CARTS_DIR):
     d.mkdir(parents=True, exist_ok=True)
+# Resolved once; the trailing separator keeps "data2/" from passing as inside "data/".
+DATA_ROOT = str(DATA_DIR.resolve()) + os.sep
+
+# Shared keep-alive pool for image downloads (postimg.cc and friends) and the sendMessage fallback.
+http = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=20, pool_maxsize=100, max_retries=Retry(total=2, backoff_factor=0.3))
+http.mount("https://", http_adapter)
+http.mount("http://", http_adapter)
+
+image_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("IMAGE_WORKERS", "4")), thread_name_prefix="images")
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("shop")
 
 
-def clone(obj: Any) -> Any:
-    return json.loads(json.dumps(obj, ensure_ascii=False))
+# save_json only records the latest object per file; a writer thread coalesces bursts
+# of mutations into one disk write per file every SAVE_DELAY seconds.
+pending_writes: Dict[str, Any] = {}
+# Queued in place of data when the file should be removed instead of written.
+DELETED = object()
+# Log entries are appended to logs.jsonl, one line each, instead of rewriting the whole file.
+pending_log_lines: List[bytes] = []
+# Lines currently in logs.jsonl; past 2 * LOG_LIMIT the file is rewritten from memory.
+log_file_lines = 0
+pending_lock = threading.Lock()
+pending_event = threading.Event()
+# Held while files are written, so a data upload never races the writer.
+io_lock = threading.Lock()
 
 
-def save_json(name: str, data: Any) -> None:
+def write_json(name: str, data: Any) -> None:
     path = DATA_DIR / name
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2))
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(orjson.dumps(data, option=JSON_OPTIONS | orjson.OPT_INDENT_2))
+    # Readers see either the old file or the new one, never a truncated write.
+    os.replace(tmp, path)
+
+
+def save_json(name: str, data: Any) -> None:
+    with pending_lock:
+        pending_writes[name] = data
+    pending_event.set()
+
+
+def delete_json(name: str) -> None:
+    save_json(name, DELETED)
+
+
+def discard_pending() -> None:
+    with pending_lock:
+        pending_writes.clear()
+        pending_log_lines.clear()
+
+
+def flush_json() -> None:
+    global log_file_lines  # noqa: PLW0603
+    with io_lock:
+        with pending_lock:
+            batch = dict(pending_writes)
+            pending_writes.clear()
+            log_lines = pending_log_lines[:]
+            pending_log_lines.clear()
+            # logs holds every entry queued so far, so it can replace the file as-is.
+            snapshot = list(logs) if log_file_lines + len(log_lines) > 2 * LOG_LIMIT else None
+        for name, data in batch.items():
+            try:
+                if data is DELETED:
+                    (DATA_DIR / name).unlink(missing_ok=True)
+                else:
+                    write_json(name, data)
+            except Exception as exc:
+                log.warning("Failed to write %s: %s", name, exc)
+        if snapshot is not None:
+            try:
+                write_log_snapshot(snapshot)
+                log_file_lines = len(snapshot)
+            except Exception as exc:
+                log.warning("Failed to compact %s: %s", LOG_FILE, exc)
+        elif log_lines:
+            try:
+                with open(DATA_DIR / LOG_FILE, "ab") as fh:
+                    fh.write(b"".join(log_lines))
+                log_file_lines += len(log_lines)
+            except Exception as exc:
+                log.warning("Failed to append %s: %s", LOG_FILE, exc)
+
+
+def json_writer() -> None:
+    while True:
+        pending_event.wait()
+        time.sleep(SAVE_DELAY)
+        pending_event.clear()
+        flush_json()
+
+
+threading.Thread(target=json_writer, name="json-writer", daemon=True).start()
+atexit.register(flush_json)
 
 
 def load_json(name: str, default: Any) -> Any:
     path = DATA_DIR / name
     if path.exists():
         try:
-            return json.loads(path.read_text())
+            return orjson.loads(path.read_bytes())
         except Exception as exc:
             log.warning("Failed to read %s: %s", name, exc)
-    data = clone(default)
+    data = copy.deepcopy(default)
     save_json(name, data)
     return data
 
 
+def dump_log_entry(entry: Dict[str, Any]) -> bytes:
+    return orjson.dumps(entry, option=JSON_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+
+
+def write_log_snapshot(entries: List[Dict[str, Any]]) -> None:
+    path = DATA_DIR / LOG_FILE
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(b"".join(dump_log_entry(e) for e in entries))
+    os.replace(tmp, path)
+
+
+def load_logs() -> List[Dict[str, Any]]:
+    global log_file_lines  # noqa: PLW0603
+    path = DATA_DIR / LOG_FILE
+    legacy = DATA_DIR / "logs.json"
+    if not path.exists():
+        # Older data dirs and exports keep logs as a single JSON list.
+        entries: List[Dict[str, Any]] = []
+        if legacy.exists():
+            try:
+                entries = orjson.loads(legacy.read_bytes())[-LOG_LIMIT:]
+            except Exception as exc:
+                log.warning("Failed to read logs.json: %s", exc)
+        write_log_snapshot(entries)
+        legacy.unlink(missing_ok=True)
+        log_file_lines = len(entries)
+        return entries
+    with open(path, "rb") as fh:
+        lines = fh.readlines()
+    log_file_lines = len(lines)
+    entries = []
+    # Only the tail is parsed; older lines are dropped by the next compaction.
+    for line in lines[-LOG_LIMIT:]:
+        try:
+            entries.append(orjson.loads(line))
+        except orjson.JSONDecodeError:
+            continue
+    return entries
+
+
+def to_int64(value: Any) -> int:
+    number = int(value)
+    if not INT64_MIN <= number <= INT64_MAX:
+        raise ValueError("integer out of range")
+    return number
+
+
 def normalize_carts(raw: Dict[str, Any]) -> Dict[int, Dict[int, int]]:
     carts: Dict[int, Dict[int, int]] = {}
     for uid, cart in raw.items():
         try:
-            uid_int = int(uid)
+            uid_int = to_int64(uid)
         except Exception:
             continue
         if not isinstance(cart, dict):
@@ -83,63 +277,146 @@ def normalize_carts(raw: Dict[str, Any]) -> Dict[int, Dict[int, int]]:
         carts[uid_int] = {}
         for pid, qty in cart.items():
             try:
-                carts[uid_int][int(pid)] = int(qty)
+                carts[uid_int][to_int64(pid)] = to_int64(qty)
             except Exception:
                 continue
     return carts
 
 
+def load_carts() -> Dict[int, Dict[int, int]]:
+    legacy = DATA_DIR / "carts.json"
+    if legacy.exists():
+        # Older data dirs and exports keep every cart in a single carts.json.
+        try:
+            legacy_carts = normalize_carts(orjson.loads(legacy.read_bytes()))
+        except Exception as exc:
+            log.warning("Failed to read carts.json: %s", exc)
+        else:
+            for uid, cart in legacy_carts.items():
+                if cart:
+                    write_json(f"carts/{uid}.json", cart)
+            legacy.unlink()
+    raw: Dict[str, Any] = {}
+    for entry in os.scandir(CARTS_DIR):
+        if not entry.name.endswith(".json"):
+            continue
+        try:
+            raw[entry.name[:-5]] = orjson.loads(Path(entry.path).read_bytes())
+        except Exception as exc:
+            log.warning("Failed to read cart %s: %s", entry.name, exc)
+    return normalize_carts(raw)
+
+
+def save_cart(uid: int) -> None:
+    cart = carts.get(uid)
+    if cart:
+        save_json(f"carts/{uid}.json", cart)
+    else:
+        delete_json(f"carts/{uid}.json")
+
+
 def load_state() -> None:
     global categories, products, carts, logs, bans, settings  # noqa: PLW0603
+    global categories_by_id, products_by_id, products_by_category, bans_by_uid  # noqa: PLW0603
+    global category_ids, product_ids  # noqa: PLW0603
     categories = load_json("categories.json", [])
     products = load_json("products.json", [])
-    carts = normalize_carts(load_json("carts.json", {}))
-    logs = load_json("logs.json", [])
+    categories_by_id = {c["id"]: c for c in categories}
+    products_by_id = {p["id"]: p for p in products}
+    # next() on itertools.count is atomic, so concurrent admin POSTs never get the same id.
+    category_ids = itertools.count(max(categories_by_id, default=0) + 1)
+    product_ids = itertools.count(max(products_by_id, default=0) + 1)
+    products_by_category = {}
+    for p in products:
+        products_by_category.setdefault(p["category_id"], []).append(p)
+    carts = load_carts()
+    logs = deque(load_logs(), maxlen=LOG_LIMIT)
     bans = load_json("bans.json", [])
+    bans_by_uid = {b.get("user_id"): b for b in bans}
     settings = load_json("settings.json", {"mode": "samootsos"})
-
-
-load_state()
+    # A restart or a failed job leaves the source URLs and the flag behind; process those again.
+    for p in products:
+        if p.get("pending_images"):
+            urls = [ph.get("image_url") for ph in p.get("photos") or [] if isinstance(ph, dict)]
+            urls = [url for url in urls if url]
+            if urls:
+                image_pool.submit(process_product_images, p, urls)
+            else:
+                p.pop("pending_images")
 
 
 def log_event(kind: str, user_id: int | None = None, payload: Dict[str, Any] | None = None) -> Dict[str, Any]:
-    entry = {"ts": datetime.utcnow().isoformat() + "Z", "kind": kind, "user_id": user_id, "payload": payload or {}}
-    logs.append(entry)
-    if len(logs) > 200:
-        logs.pop(0)
-    save_json("logs.json", logs)
+    entry = {"ts": time.time(), "kind": kind, "user_id": user_id, "payload": payload or {}}
+    line = dump_log_entry(entry)
+    # Appended together so a compaction snapshot never holds an entry that is still queued.
+    with pending_lock:
+        logs.append(entry)
+        pending_log_lines.append(line)
+    pending_event.set()
     return entry
 
 
-def next_id(items: List[Dict[str, Any]]) -> int:
-    return max((item["id"] for item in items), default=0) + 1
+def format_ts(ts: Any) -> Any:
+    # Entries are stored with a unix timestamp; older ones already hold the ISO string.
+    if isinstance(ts, (int, float)):
+        return datetime.fromtimestamp(ts, timezone.utc).isoformat().removesuffix("+00:00") + "Z"
+    return ts
 
 
 def is_banned(user_id: int | None) -> bool:
     if user_id is None:
         return False
-    return any(b.get("user_id") == int(user_id) for b in bans)
+    return int(user_id) in bans_by_uid
+
+
+def escapes_data_dir(rel_path: str) -> bool:
+    # Lexical check only; catches ../ and absolute paths without touching the filesystem.
+    normalized = os.path.normpath(rel_path)
+    return os.path.isabs(normalized) or normalized == ".." or normalized.startswith(".." + os.sep)
+
+
+def in_data_dir(path: Path) -> bool:
+    return (str(path) + os.sep).startswith(DATA_ROOT)
 
 
 def safe_media_path(rel_path: str) -> Path:
+    if escapes_data_dir(rel_path):
+        abort(400, description="invalid media path")
+    # resolve() is still needed to catch symlinks pointing outside DATA_DIR.
     candidate = (DATA_DIR / rel_path).resolve()
-    if not str(candidate).startswith(str(DATA_DIR.resolve())):
+    if not in_data_dir(candidate):
         abort(400, description="invalid media path")
     return candidate
 
 
+def read_json() -> Dict[str, Any]:
+    return parse_json(request.get_data(cache=False))
+
+
+def parse_json(raw: bytes) -> Dict[str, Any]:
+    if not raw:
+        return {}
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
 def verify_secret() -> None:
-    if not WEBHOOK_SECRET:
+    if not WEBHOOK_SECRET_BYTES:
         return
-    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+    provided = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode("latin-1")
+    if not hmac.compare_digest(provided, WEBHOOK_SECRET_BYTES):
         abort(401)
 
 
 def require_admin() -> None:
-    if not ADMIN_TOKEN:
+    if not ADMIN_TOKEN_BYTES:
         return
-    provided = request.headers.get("X-Admin-Token") or request.args.get("token")
-    if provided != ADMIN_TOKEN:
+    provided = request.headers.get("X-Admin-Token") or request.args.get("token") or ""
+    # Constant time, so response timing does not reveal how much of the token matched.
+    if not hmac.compare_digest(provided.encode(), ADMIN_TOKEN_BYTES):
         abort(401)
 
 
@@ -150,27 +427,59 @@ def resolve_admin_url() -> str:
     return base.rstrip("/") + "/admin"
 
 
-def send_sync(chat_id: int, text: str, reply_markup: Any | None = None) -> bool:
-    async def run() -> None:
-        await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+ADMIN_URL = resolve_admin_url()
+SHOP_BUTTON = InlineKeyboardButton(text="Открыть магазин", web_app=WebAppInfo(url=WEBAPP_URL))
+USER_KB = InlineKeyboardMarkup([[SHOP_BUTTON]])
+ADMIN_KB = InlineKeyboardMarkup([[SHOP_BUTTON, InlineKeyboardButton(text="Админ-панель", url=ADMIN_URL)]])
+START_TEXT = "Нажми кнопку, чтобы открыть мини-приложение."
+HINT_TEXT = "Отправь /start, чтобы открыть мини-приложение."
+
+
+def run_async(coro: Awaitable[Any], timeout: float | None = None) -> Any:
+    return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
 
+
+async def send_message(chat_id: int, text: str, reply_markup: Any | None = None) -> bool:
     try:
-        asyncio.run(run())
+        await asyncio.wait_for(bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup), SEND_TIMEOUT)
         return True
-    except (TimedOut, NetworkError) as exc:
+    except (TimedOut, NetworkError, asyncio.TimeoutError) as exc:
         log.warning("Send timeout/network: %s", exc)
     except Exception as exc:
         log.exception("Send failed: %s", exc)
     return False
 
 
+def split_message(text: str, limit: int = TG_MESSAGE_LIMIT) -> List[str]:
+    chunks: List[str] = []
+    current = ""
+    for line in text.split("\n"):
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+        if current:
+            chunks.append(current)
+        rest = line
+        while len(rest) > limit:
+            chunks.append(rest[:limit])
+            rest = rest[limit:]
+        current = rest
+    if current:
+        chunks.append(current)
+    return chunks
+
+
 def notify_admin(text: str) -> bool:
     if not ADMIN_CHAT_ID:
         return False
-    if send_sync(ADMIN_CHAT_ID, text):
-        return True
+    loop.call_soon_threadsafe(outbox.put_nowait, text)
+    return True
+
+
+def send_admin_fallback(text: str) -> bool:
     try:
-        resp = requests.post(
+        resp = http.post(
             f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
             json={"chat_id": ADMIN_CHAT_ID, "text": text},
             timeout=10,
@@ -183,44 +492,172 @@ def notify_admin(text: str) -> bool:
     return False
 
 
-def download_image(url: str) -> Image.Image | None:
-    candidates = [url]
-    if "postimg.cc" in url:
-        parts = [p for p in url.split("/") if p]
-        if len(parts) >= 2:
-            album, name = parts[-2], parts[-1]
-            candidates.insert(0, f"https://i.postimg.cc/{album}/{name}.jpg")
-            candidates.insert(1, f"https://i.postimg.cc/{album}/{name}.png")
-    img = None
-    for candidate in candidates:
+async def send_admin(text: str) -> bool:
+    if await send_message(ADMIN_CHAT_ID, text):
+        return True
+    return await loop.run_in_executor(None, send_admin_fallback, text)
+
+
+# Admin notifications are queued so checkout never waits on Telegram; one consumer delivers them.
+outbox: "asyncio.Queue[str]" = asyncio.Queue()
+
+
+async def outbox_worker() -> None:
+    while True:
+        text = await outbox.get()
+        try:
+            # Large carts can exceed Telegram's message size; every chunk is attempted.
+            results = [await send_admin(chunk) for chunk in split_message(text)]
+            if not all(results):
+                # The full text is logged so an undelivered order can still be recovered.
+                log.warning("Failed to deliver admin notification:\n%s", text)
+        except Exception as exc:
+            log.exception("Admin notification failed: %s", exc)
+        finally:
+            outbox.task_done()
+
+
+asyncio.run_coroutine_threadsafe(outbox_worker(), loop)
+
+
+def start_bot() -> None:
+    # The HTTPX pool is opened once, bound to the shared loop, and reused by every send.
+    try:
+        run_async(bot.initialize(), timeout=SEND_TIMEOUT)
+    except Exception as exc:
+        log.warning("Bot initialize failed: %s", exc)
+
+
+def stop_bot() -> None:
+    try:
+        run_async(bot.shutdown(), timeout=5)
+    except Exception as exc:
+        log.warning("Bot shutdown failed: %s", exc)
+
+
+start_bot()
+atexit.register(stop_bot)
+
+
+# Page links only; direct i.postimg.cc image links are downloaded as they are.
+POSTIMG_PAGE_RE = re.compile(r"^https?://(?:www\.)?postimg\.cc/([^/?#]+)/([^/?#]+)")
+
+
+@lru_cache(maxsize=256)
+def image_candidates(url: str) -> Tuple[str, ...]:
+    # postimg.cc page links are tried as direct i.postimg.cc image links first.
+    m = POSTIMG_PAGE_RE.match(url)
+    if m:
+        album, name = m.groups()
+        return (
+            f"https://i.postimg.cc/{album}/{name}.jpg",
+            f"https://i.postimg.cc/{album}/{name}.png",
+            url,
+        )
+    return (url,)
+
+
+def has_variants(name: str) -> bool:
+    return (IMAGES_DIR / name).exists() and (THUMBS_DIR / name).exists()
+
+
+def open_image(data: bytes) -> Tuple[str, Image.Image | None]:
+    # Files are named by content, so the same picture is only encoded once.
+    name = hashlib.blake2b(data, digest_size=16).hexdigest() + ".jpg"
+    if has_variants(name):
+        return name, None
+    img = Image.open(io.BytesIO(data))
+    # Let libjpeg downscale while decoding; nothing larger than 1600px is kept.
+    img.draft("RGB", (1600, 1600))
+    return name, img.convert("RGB")
+
+
+def local_media_path(rel_path: str) -> Path | None:
+    if escapes_data_dir(rel_path):
+        return None
+    candidate = (DATA_DIR / rel_path).resolve()
+    return candidate if in_data_dir(candidate) and candidate.is_file() else None
+
+
+def download_image(url: str) -> Tuple[str, Image.Image | None] | None:
+    # Our own /media files, e.g. from a resubmitted product, are read from disk.
+    if url.startswith("/media/"):
+        path = local_media_path(url[len("/media/"):])
+        if path is None:
+            return None
+        if has_variants(path.name):
+            return path.name, None
+        try:
+            return open_image(path.read_bytes())
+        except Exception as exc:
+            log.warning("Local image failed %s: %s", url, exc)
+            return None
+    # Other local paths such as the SVG placeholder are served as-is.
+    if not url.startswith(("http://", "https://")):
+        return None
+    for candidate in image_candidates(url):
         try:
-            resp = requests.get(candidate, timeout=20)
+            resp = http.get(candidate, timeout=20)
             resp.raise_for_status()
-            img = Image.open(io.BytesIO(resp.content)).convert("RGB")
-            break
+            return open_image(resp.content)
         except Exception as exc:
             log.warning("Download failed %s: %s", candidate, exc)
-    return img
+    return None
 
 
-def save_variants(img: Image.Image, product_id: int, idx: int) -> Tuple[str | None, str | None]:
-    def save_copy(max_size: int, folder: Path, prefix: str) -> str | None:
+def save_variants(img: Image.Image, name: str) -> Tuple[str | None, str | None]:
+    # Shrinks img in place: the 1600px variant is saved, then reduced further to the thumbnail.
+    def save_resized(
+        max_size: int, folder: Path, prefix: str, resample: Image.Resampling, **options: Any
+    ) -> str | None:
+        # Written under a temporary name, since another product may already be serving this file.
+        tmp = folder / f"{name}.{threading.get_ident()}.tmp"
         try:
-            clone = img.copy()
-            clone.thumbnail((max_size, max_size))
-            name = f"product_{product_id}_{idx}.jpg"
-            path = folder / name
-            clone.save(path, format="JPEG", optimize=True, quality=85)
+            img.thumbnail((max_size, max_size), resample)
+            img.save(tmp, format="JPEG", progressive=True, subsampling="4:2:0", **options)
+            os.replace(tmp, folder / name)
             return f"/media/{prefix}/{name}"
         except Exception as exc:
             log.warning("Save variant failed: %s", exc)
+            tmp.unlink(missing_ok=True)
             return None
 
-    return save_copy(1600, IMAGES_DIR, "images"), save_copy(600, THUMBS_DIR, "thumbs")
+    # optimize=True's extra Huffman pass and the sharper bicubic filter only pay off on the large variant.
+    return (
+        save_resized(1600, IMAGES_DIR, "images", Image.Resampling.BICUBIC, quality=85, optimize=True),
+        save_resized(600, THUMBS_DIR, "thumbs", Image.Resampling.BILINEAR, quality=75, optimize=False),
+    )
+
+
+def process_product_images(product: Dict[str, Any], urls: List[str]) -> None:
+    try:
+        photos: List[Dict[str, str]] = []
+        for url in urls:
+            downloaded = download_image(url)
+            if downloaded:
+                name, img = downloaded
+                if img:
+                    main_url, thumb = save_variants(img, name)
+                else:
+                    main_url, thumb = f"/media/images/{name}", f"/media/thumbs/{name}"
+                photos.append({"image_url": main_url or url, "thumb_url": thumb or main_url or url})
+            else:
+                photos.append({"image_url": url, "thumb_url": url})
+        # Checked by identity: after a data upload another product may have the same id.
+        if products_by_id.get(product["id"]) is not product:
+            return
+        product["photos"] = photos
+        product["image_url"] = photos[0]["image_url"]
+        product["thumb_url"] = photos[0]["thumb_url"]
+        product.pop("pending_images", None)
+        invalidate_catalog()
+        save_json("products.json", products)
+    except Exception as exc:
+        log.exception("Image processing failed for product %s: %s", product.get("id"), exc)
 
 
 def get_product(product_id: int) -> Dict[str, Any] | None:
-    return next((p for p in products if p["id"] == product_id), None)
+    return products_by_id.get(product_id)
 
 
 def admin_mode() -> str:
@@ -251,19 +688,94 @@ def build_photos(product: Dict[str, Any]) -> List[Dict[str, str]]:
     return normalized
 
 
+def list_products(cid: int | None) -> List[Dict[str, Any]]:
+    items = products_by_category.get(cid, []) if cid else products
+    resp = []
+    for p in items:
+        p_copy = dict(p)
+        p_copy["photos"] = build_photos(p)
+        if p_copy["photos"]:
+            p_copy["image_url"] = p_copy["photos"][0]["image_url"]
+            p_copy["thumb_url"] = p_copy["photos"][0]["thumb_url"]
+        resp.append(p_copy)
+    return resp
+
+
+# Serialized catalog GET bodies and their ETags, dropped on every catalog write.
+catalog_cache: Dict[Any, Tuple[bytes, str]] = {}
+catalog_lock = threading.Lock()
+catalog_version = 0
+
+
+def invalidate_catalog() -> None:
+    global catalog_version  # noqa: PLW0603
+    with catalog_lock:
+        catalog_version += 1
+        catalog_cache.clear()
+
+
+def cached_json(key: Any, build: Callable[[], Any]) -> Response:
+    entry = catalog_cache.get(key)
+    if entry is None:
+        version = catalog_version
+        body = orjson.dumps(build(), option=JSON_OPTIONS)
+        entry = (body, hashlib.blake2b(body, digest_size=8).hexdigest())
+        with catalog_lock:
+            # Do not store a body built from state that changed while it was serialized.
+            if version == catalog_version:
+                catalog_cache[key] = entry
+    body, etag = entry
+    resp = app.response_class(body, mimetype="application/json")
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
+
+OK_BODY = orjson.dumps({"ok": True})
+
+
+@lru_cache(maxsize=64)
+def error_body(error: str) -> bytes:
+    return orjson.dumps({"ok": False, "error": error})
+
+
+def ok_response() -> Response:
+    return app.response_class(OK_BODY, mimetype="application/json")
+
+
+def error_response(error: str, status: int) -> Response:
+    return app.response_class(error_body(error), status=status, mimetype="application/json")
+
+
 @app.route("/")
 def health() -> Any:
     return {"ok": True}
 
 
+def load_page(name: str) -> Tuple[bytes, str]:
+    body = (Path(app.static_folder) / name).read_bytes()
+    return body, hashlib.blake2b(body, digest_size=8).hexdigest()
+
+
+PAGES = {name: load_page(name) for name in ("index.html", "admin.html")}
+
+
+def serve_page(name: str) -> Response:
+    body, etag = PAGES[name]
+    resp = app.response_class(body, mimetype="text/html")
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 300
+    return resp.make_conditional(request)
+
+
 @app.route("/webapp")
 def webapp_page() -> Any:
-    return send_from_directory(app.static_folder, "index.html")
+    return serve_page("index.html")
 
 
 @app.route("/admin")
 def admin_page() -> Any:
-    return send_from_directory(app.static_folder, "admin.html")
+    return serve_page("admin.html")
 
 
 @app.route("/media/<path:filename>")
@@ -271,22 +783,34 @@ def media(filename: str) -> Any:
     path = safe_media_path(filename)
     if not path.exists() or not path.is_file():
         abort(404)
-    return send_file(path)
+    if MEDIA_ACCEL_PREFIX:
+        # nginx sends the file itself; the worker only validates the path.
+        resp = Response(mimetype=mimetypes.guess_type(path.name)[0] or "application/octet-stream")
+        # Percent-encoded: the header must be latin-1, and nginx would misread ? % # and spaces.
+        resp.headers["X-Accel-Redirect"] = f"{MEDIA_ACCEL_PREFIX}/{quote(str(path)[len(DATA_ROOT):], safe='/')}"
+        return resp
+    return send_file(path, conditional=True, etag=True, max_age=MEDIA_MAX_AGE)
 
 
 @app.route("/api/categories", methods=["GET", "POST"])
 def api_categories() -> Any:
     if request.method == "GET":
-        return jsonify({"items": categories})
+        return cached_json("categories", lambda: {"items": categories})
     require_admin()
-    body = request.get_json(force=True, silent=True) or {}
+    body = read_json()
     name = (body.get("name") or "").strip()
     icon = (body.get("icon") or "").strip() or None
     parent_id = body.get("parent_id")
     if not name:
-        return jsonify({"ok": False, "error": "name required"}), 400
-    cat = {"id": next_id(categories), "name": name, "icon": icon, "parent_id": int(parent_id) if parent_id else None}
+        return error_response("name required", 400)
+    try:
+        parent = to_int64(parent_id) if parent_id else None
+    except (TypeError, ValueError):
+        return error_response("invalid parent_id", 400)
+    cat = {"id": next(category_ids), "name": name, "icon": icon, "parent_id": parent}
     categories.append(cat)
+    categories_by_id[cat["id"]] = cat
+    invalidate_catalog()
     log_event("category_created", payload=cat)
     save_json("categories.json", categories)
     return jsonify(cat), 201
@@ -295,59 +819,64 @@ def api_categories() -> Any:
 @app.route("/api/categories/<int:cat_id>", methods=["PATCH", "DELETE"])
 def api_category_update(cat_id: int) -> Any:
     require_admin()
-    category = next((c for c in categories if c["id"] == cat_id), None)
+    category = categories_by_id.get(cat_id)
     if not category:
-        return jsonify({"ok": False, "error": "category not found"}), 404
+        return error_response("category not found", 404)
     if request.method == "PATCH":
-        body = request.get_json(force=True, silent=True) or {}
+        body = read_json()
         name = (body.get("name") or "").strip()
         icon = (body.get("icon") or "").strip()
         parent_id = body.get("parent_id")
+        try:
+            parent = to_int64(parent_id) if parent_id else None
+        except (TypeError, ValueError):
+            return error_response("invalid parent_id", 400)
         if name:
             category["name"] = name
         category["icon"] = icon or None
-        category["parent_id"] = int(parent_id) if parent_id else None
+        category["parent_id"] = parent
+        invalidate_catalog()
         log_event("category_updated", payload=category)
         save_json("categories.json", categories)
         return jsonify(category)
+    del categories_by_id[cat_id]
     categories[:] = [c for c in categories if c["id"] != cat_id]
-    for p in products:
-        if p["category_id"] == cat_id:
-            p["category_id"] = None
+    for p in products_by_category.pop(cat_id, []):
+        p["category_id"] = None
+        products_by_category.setdefault(None, []).append(p)
+    invalidate_catalog()
     log_event("category_deleted", payload={"id": cat_id})
     save_json("categories.json", categories)
     save_json("products.json", products)
-    return jsonify({"ok": True})
+    return ok_response()
 
 
-@app.route("/api/products", methods=["GET", "POST"])
+@app.route("/api/products", methods=["GET", "POST", "DELETE"])
 def api_products() -> Any:
     if request.method == "GET":
         cid = request.args.get("category_id", type=int)
-        items = [p for p in products if p["category_id"] == cid] if cid else products
-        resp = []
-        for p in items:
-            p_copy = dict(p)
-            p_copy["photos"] = build_photos(p)
-            if p_copy["photos"]:
-                p_copy["image_url"] = p_copy["photos"][0]["image_url"]
-                p_copy["thumb_url"] = p_copy["photos"][0]["thumb_url"]
-            resp.append(p_copy)
-        return jsonify({"items": resp})
+        if cid is not None and cid not in categories_by_id:
+            # Only real categories are cached; arbitrary query values must not grow the cache.
+            return jsonify({"items": list_products(cid)})
+        return cached_json(("products", cid), lambda: {"items": list_products(cid)})
     if request.method == "DELETE":
         require_admin()
         pid = request.args.get("id", type=int)
         if not pid:
-            return jsonify({"ok": False, "error": "product_id required"}), 400
-        before = len(products)
+            return error_response("product_id required", 400)
+        product = products_by_id.pop(pid, None)
+        if product is None:
+            return error_response("not_found", 404)
         products[:] = [p for p in products if p["id"] != pid]
-        if len(products) == before:
-            return jsonify({"ok": False, "error": "not_found"}), 404
+        bucket = products_by_category.get(product["category_id"], [])
+        if product in bucket:
+            bucket.remove(product)
+        invalidate_catalog()
         log_event("product_deleted", payload={"id": pid})
         save_json("products.json", products)
-        return jsonify({"ok": True})
+        return ok_response()
     require_admin()
-    body = request.get_json(force=True, silent=True) or {}
+    body = read_json()
     title = (body.get("title") or "").strip()
     price = body.get("price")
     category_id = body.get("category_id")
@@ -356,42 +885,34 @@ def api_products() -> Any:
     thumb_url = (body.get("thumb_url") or "").strip()
     description = (body.get("description") or "").strip()
     if not title or price is None or category_id is None:
-        return jsonify({"ok": False, "error": "title, price, category_id required"}), 400
+        return error_response("title, price, category_id required", 400)
+    try:
+        price_value = float(price)
+        # NaN and inf would be written to products.json as null and break cart totals on reload.
+        if not math.isfinite(price_value):
+            raise ValueError("price must be finite")
+        cid = to_int64(category_id)
+    except (TypeError, ValueError):
+        return error_response("invalid price or category_id", 400)
     product = {
-        "id": next_id(products),
+        "id": next(product_ids),
         "title": title,
-        "price": float(price),
-        "category_id": int(category_id),
+        "price": price_value,
+        "category_id": cid,
         "image_url": image_url or "/static/img/placeholder.svg",
         "thumb_url": thumb_url,
         "description": description,
     }
-    photos: List[Dict[str, str]] = []
     urls = images_list if isinstance(images_list, list) and images_list else []
     if image_url:
         urls.insert(0, image_url)
-    seen = []
-    for idx, url in enumerate(urls):
+    seen: List[str] = []
+    for url in urls:
         url_clean = (url or "").strip()
-        if not url_clean or url_clean in seen:
-            continue
-        seen.append(url_clean)
-        img = download_image(url_clean)
-        if img:
-            main_url, thumb = save_variants(img, product["id"], idx)
-            photos.append(
-                {
-                    "image_url": main_url or url_clean,
-                    "thumb_url": thumb or main_url or url_clean,
-                }
-            )
-        else:
-            photos.append(
-                {
-                    "image_url": url_clean,
-                    "thumb_url": url_clean,
-                }
-            )
+        if url_clean and url_clean not in seen:
+            seen.append(url_clean)
+    # Serve the source URLs until the background job has stored local copies.
+    photos = [{"image_url": url, "thumb_url": url} for url in seen]
     if not photos:
         photos.append(
             {
@@ -402,88 +923,97 @@ def api_products() -> Any:
     product["photos"] = photos
     product["image_url"] = photos[0]["image_url"]
     product["thumb_url"] = photos[0]["thumb_url"]
+    if seen:
+        product["pending_images"] = True
     products.append(product)
+    products_by_id[product["id"]] = product
+    products_by_category.setdefault(product["category_id"], []).append(product)
+    invalidate_catalog()
     log_event("product_created", payload=product)
     save_json("products.json", products)
+    if seen:
+        image_pool.submit(process_product_images, product, seen)
     return jsonify(product), 201
 
 
 @app.route("/api/cart/add", methods=["POST"])
 def api_cart_add() -> Any:
-    body = request.get_json(force=True, silent=True) or {}
+    body = read_json()
     user_id = body.get("user_id")
     product_id = body.get("product_id")
-    qty = int(body.get("qty") or 1)
     if not user_id or not product_id:
-        return jsonify({"ok": False, "error": "user_id and product_id required"}), 400
-    if is_banned(int(user_id)):
-        return jsonify({"ok": False, "error": "banned"}), 403
-    product = get_product(int(product_id))
+        return error_response("user_id and product_id required", 400)
+    try:
+        uid = to_int64(user_id)
+        pid = to_int64(product_id)
+        qty = max(1, int(body.get("qty") or 1))
+    except (TypeError, ValueError):
+        return error_response("invalid user_id, product_id or qty", 400)
+    if is_banned(uid):
+        return error_response("banned", 403)
+    product = get_product(pid)
     if not product:
-        return jsonify({"ok": False, "error": "product not found"}), 404
-    cart = carts.setdefault(int(user_id), {})
-    cart[int(product_id)] = cart.get(int(product_id), 0) + max(1, qty)
-    log_event("cart_add", user_id=int(user_id), payload={"product_id": int(product_id), "qty": qty})
-    save_json("carts.json", carts)
-    return jsonify({"ok": True})
+        return error_response("product not found", 404)
+    if carts.get(uid, {}).get(pid, 0) + qty > MAX_CART_QTY:
+        return error_response(f"qty must not exceed {MAX_CART_QTY}", 400)
+    cart = carts.setdefault(uid, {})
+    cart[pid] = cart.get(pid, 0) + qty
+    log_event("cart_add", user_id=uid, payload={"product_id": pid, "qty": qty})
+    save_cart(uid)
+    return ok_response()
+
+
+EMPTY_CART_BODY = orjson.dumps({"items": [], "total": 0.0})
 
 
 @app.route("/api/cart/<int:user_id>", methods=["GET"])
 def api_cart_get(user_id: int) -> Any:
-    cart = carts.get(user_id, {})
-    items: List[Dict[str, Any]] = []
-    total = 0.0
-    for pid, qty in cart.items():
-        product = get_product(pid)
-        if not product:
-            continue
-        subtotal = product["price"] * qty
-        total += subtotal
-        items.append({"product": product, "qty": qty, "subtotal": subtotal})
-    return jsonify({"items": items, "total": total})
+    cart = carts.get(user_id)
+    if not cart:
+        return app.response_class(EMPTY_CART_BODY, mimetype="application/json")
+    items = [
+        {"product": product, "qty": qty, "subtotal": product["price"] * qty}
+        for pid, qty in cart.items()
+        if (product := get_product(pid))
+    ]
+    return jsonify({"items": items, "total": math.fsum(item["subtotal"] for item in items)})
 
 
 @app.route("/api/cart/clear", methods=["POST"])
 def api_cart_clear() -> Any:
-    body = request.get_json(force=True, silent=True) or {}
+    body = read_json()
     user_id = body.get("user_id")
     if not user_id:
-        return jsonify({"ok": False, "error": "user_id required"}), 400
-    if is_banned(int(user_id)):
-        return jsonify({"ok": False, "error": "banned"}), 403
-    carts[int(user_id)] = {}
-    log_event("cart_clear", user_id=int(user_id))
-    save_json("carts.json", carts)
-    return jsonify({"ok": True})
+        return error_response("user_id required", 400)
+    try:
+        uid = to_int64(user_id)
+    except (TypeError, ValueError):
+        return error_response("invalid user_id", 400)
+    if is_banned(uid):
+        return error_response("banned", 403)
+    carts.pop(uid, None)
+    log_event("cart_clear", user_id=uid)
+    save_cart(uid)
+    return ok_response()
 
 
 @app.route("/api/cart/checkout", methods=["POST"])
 def api_cart_checkout() -> Any:
-    body = request.get_json(force=True, silent=True) or {}
+    body = read_json()
     user_id = body.get("user_id")
     contact = (body.get("contact") or "").strip()
     note = (body.get("note") or "").strip()
     tg_username = (body.get("tg_username") or "").strip()
     tg_name = (body.get("tg_name") or "").strip()
     if not user_id:
-        return jsonify({"ok": False, "error": "user_id required"}), 400
-    if is_banned(int(user_id)):
-        return jsonify({"ok": False, "error": "banned"}), 403
-    cart = carts.get(int(user_id), {})
-    items: List[Dict[str, Any]] = []
-    total = 0.0
-    for pid, qty in cart.items():
-        product = get_product(pid)
-        if not product:
-            continue
-        subtotal = product["price"] * qty
-        total += subtotal
-        items.append({"product": product, "qty": qty, "subtotal": subtotal})
-    if not items:
-        return jsonify({"ok": False, "error": "cart_empty"}), 400
-
-    log_event("checkout", user_id=int(user_id), payload={"contact": contact, "note": note, "items": cart})
-
+        return error_response("user_id required", 400)
+    try:
+        uid = to_int64(user_id)
+    except (TypeError, ValueError):
+        return error_response("invalid user_id", 400)
+    if is_banned(uid):
+        return error_response("banned", 403)
+    cart = carts.get(uid, {})
     mode = admin_mode()
     response: Dict[str, Any] = {"ok": True}
     lines: List[str] = []
@@ -495,7 +1025,7 @@ def api_cart_checkout() -> Any:
         lines.extend(
             [
                 "🛒 Новый заказ",
-                f"user_id: {user_id}",
+                f"user_id: {uid}",
                 f"tg: @{tg_username}" if tg_username else "tg: не указал",
             ]
         )
@@ -506,9 +1036,19 @@ def api_cart_checkout() -> Any:
             lines.append(f"Комментарий: {note}")
 
     lines.append("Позиций:")
-    for row in items:
-        lines.append(f"- {row['product']['title']} x{row['qty']} = {int(row['subtotal'])}₽")
-    lines.append(f"Итого: {int(total)}₽")
+    subtotals: List[float] = []
+    for pid, qty in cart.items():
+        product = get_product(pid)
+        if not product:
+            continue
+        subtotal = product["price"] * qty
+        subtotals.append(subtotal)
+        lines.append(f"- {product['title']} x{qty} = {int(subtotal)}₽")
+    if not subtotals:
+        return error_response("cart_empty", 400)
+    lines.append(f"Итого: {int(math.fsum(subtotals))}₽")
+
+    log_event("checkout", user_id=uid, payload={"contact": contact, "note": note, "items": cart})
 
     if mode == "samopis":
         if SAMOPIS_NICK:
@@ -516,13 +1056,11 @@ def api_cart_checkout() -> Any:
             response["redirect"] = f"https://t.me/{SAMOPIS_NICK}?text={quote_plus(text)}"
             response["message"] = "Откройте диалог для оформления."
     else:
-        if ADMIN_CHAT_ID:
-            if not notify_admin("\n".join(lines)):
-                log.warning("Failed to notify admin about checkout for user %s", user_id)
+        notify_admin("\n".join(lines))
         response["message"] = "Заказ принят. Менеджер свяжется в Telegram."
 
-    carts[int(user_id)] = {}
-    save_json("carts.json", carts)
+    carts.pop(uid, None)
+    save_cart(uid)
     return jsonify(response)
 
 
@@ -530,7 +1068,8 @@ def api_cart_checkout() -> Any:
 def api_admin_logs() -> Any:
     require_admin()
     limit = request.args.get("limit", default=50, type=int)
-    return jsonify({"items": logs[-limit:]})
+    items = [dict(entry, ts=format_ts(entry.get("ts"))) for entry in list(logs)[-limit:]]
+    return jsonify({"items": items})
 
 
 @app.route("/api/admin/bans", methods=["GET", "POST"])
@@ -538,17 +1077,18 @@ def api_admin_bans() -> Any:
     require_admin()
     if request.method == "GET":
         return jsonify({"items": bans})
-    body = request.get_json(force=True, silent=True) or {}
+    body = read_json()
     user_id = body.get("user_id")
     reason = (body.get("reason") or "").strip()
     try:
-        uid = int(user_id)
+        uid = to_int64(user_id)
     except Exception:
-        return jsonify({"ok": False, "error": "user_id required"}), 400
-    if any(b["user_id"] == uid for b in bans):
-        return jsonify({"ok": False, "error": "already banned"}), 400
+        return error_response("user_id required", 400)
+    if uid in bans_by_uid:
+        return error_response("already banned", 400)
     ban = {"user_id": uid, "reason": reason}
     bans.append(ban)
+    bans_by_uid[uid] = ban
     log_event("user_banned", user_id=uid, payload={"reason": reason})
     save_json("bans.json", bans)
     return jsonify(ban), 201
@@ -557,13 +1097,12 @@ def api_admin_bans() -> Any:
 @app.route("/api/admin/bans/<int:user_id>", methods=["DELETE"])
 def api_admin_bans_delete(user_id: int) -> Any:
     require_admin()
-    before = len(bans)
+    if bans_by_uid.pop(user_id, None) is None:
+        return error_response("not found", 404)
     bans[:] = [b for b in bans if b["user_id"] != user_id]
-    if len(bans) == before:
-        return jsonify({"ok": False, "error": "not found"}), 404
     log_event("user_unbanned", user_id=user_id)
     save_json("bans.json", bans)
-    return jsonify({"ok": True})
+    return ok_response()
 
 
 @app.route("/api/admin/mode", methods=["GET", "POST"])
@@ -571,25 +1110,68 @@ def api_admin_mode() -> Any:
     require_admin()
     if request.method == "GET":
         return jsonify({"mode": admin_mode()})
-    body = request.get_json(force=True, silent=True) or {}
+    body = read_json()
     mode = (body.get("mode") or "").strip()
     if mode not in {"samootsos", "samopis"}:
-        return jsonify({"ok": False, "error": "invalid_mode"}), 400
+        return error_response("invalid_mode", 400)
     settings["mode"] = mode
     save_json("settings.json", settings)
     return jsonify({"ok": True, "mode": mode})
 
 
-def create_data_zip(tmpdir: Path) -> Path:
-    zip_path = tmpdir / "data.zip"
-    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+class ZipSink(io.RawIOBase):
+    # Unseekable write target for ZipFile; drain() hands out what has been written so far.
+    def __init__(self) -> None:
+        super().__init__()
+        self.chunks: deque[bytes] = deque()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b: Any) -> int:
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_data_zip() -> Iterator[bytes]:
+    sink = ZipSink()
+    # Level 1 is several times faster than the default for slightly larger JSON.
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED, compresslevel=1, strict_timestamps=False) as zf:
         for path in DATA_DIR.rglob("*"):
-            if path.is_file():
-                zf.write(path, arcname=path.relative_to(DATA_DIR))
-    return zip_path
+            # *.tmp files are half-written JSON snapshots that are about to be renamed.
+            if not path.is_file() or path.suffix == ".tmp":
+                continue
+            arcname = path.relative_to(DATA_DIR)
+            if path.suffix.lower() not in ZIP_STORED_SUFFIXES:
+                # JSON files are small; write() deflates them with the archive's settings.
+                zf.write(path, arcname)
+                yield sink.drain()
+                continue
+            info = zipfile.ZipInfo.from_file(path, arcname=arcname, strict_timestamps=False)
+            info.compress_type = zipfile.ZIP_STORED
+            with open(path, "rb") as src, zf.open(info, "w") as dst:
+                while chunk := src.read(ZIP_CHUNK_SIZE):
+                    dst.write(chunk)
+                    if sink.chunks:
+                        yield sink.drain()
+    yield sink.drain()
+
+
+def extract_members(zip_path: Path, members: List[Tuple[zipfile.ZipInfo, Path]]) -> None:
+    # A ZipFile handle must not be shared between threads, so each worker opens its own.
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        for member, dest in members:
+            with zf.open(member) as src, open(dest, "wb") as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER)
 
 
 def safe_extract(zip_path: Path) -> None:
+    files: List[Tuple[zipfile.ZipInfo, Path]] = []
     with zipfile.ZipFile(zip_path, "r") as zf:
         for member in zf.infolist():
             name = member.filename
@@ -598,22 +1180,30 @@ def safe_extract(zip_path: Path) -> None:
             if name.startswith("/") or ".." in Path(name).parts:
                 raise ValueError("unsafe path")
             dest = (DATA_DIR / name).resolve()
-            if not str(dest).startswith(str(DATA_DIR.resolve())):
+            if not in_data_dir(dest):
                 raise ValueError("unsafe path")
             dest.parent.mkdir(parents=True, exist_ok=True)
             if member.is_dir():
                 dest.mkdir(parents=True, exist_ok=True)
                 continue
-            with zf.open(member) as src, open(dest, "wb") as dst:
-                shutil.copyfileobj(src, dst)
+            files.append((member, dest))
+    if not files:
+        return
+    # Every path is checked above; only the copying runs in parallel.
+    workers = min(EXTRACT_WORKERS, len(files))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="extract") as pool:
+        list(pool.map(lambda i: extract_members(zip_path, files[i::workers]), range(workers)))
 
 
 @app.route("/api/admin/data/download", methods=["GET"])
 def api_admin_data_download() -> Any:
     require_admin()
-    with tempfile.TemporaryDirectory() as tmpdir:
-        zip_path = create_data_zip(Path(tmpdir))
-        return send_file(zip_path, as_attachment=True, download_name="data.zip")
+    flush_json()
+    return Response(
+        iter_data_zip(),
+        mimetype="application/zip",
+        headers={"Content-Disposition": "attachment; filename=data.zip"},
+    )
 
 
 @app.route("/api/admin/data/upload", methods=["POST"])
@@ -621,84 +1211,113 @@ def api_admin_data_upload() -> Any:
     require_admin()
     file = request.files.get("file")
     if not file:
-        return jsonify({"ok": False, "error": "file_required"}), 400
+        return error_response("file_required", 400)
     with tempfile.TemporaryDirectory() as tmpdir:
         tmp_path = Path(tmpdir) / "upload.zip"
-        file.save(tmp_path)
-        try:
-            for child in DATA_DIR.iterdir():
-                if child.is_file():
-                    child.unlink()
-                else:
-                    shutil.rmtree(child)
-            safe_extract(tmp_path)
-        except Exception as exc:
-            log.exception("Extract failed: %s", exc)
-            return jsonify({"ok": False, "error": "extract_failed"}), 400
-    for d in (IMAGES_DIR, THUMBS_DIR):
-        d.mkdir(parents=True, exist_ok=True)
-    load_state()
-    return jsonify({"ok": True})
+        with open(tmp_path, "wb") as dst:
+            shutil.copyfileobj(file.stream, dst, COPY_BUFFER)
+        with io_lock:
+            discard_pending()
+            try:
+                for entry in os.scandir(DATA_DIR):
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.unlink(entry.path)
+                safe_extract(tmp_path)
+            except Exception as exc:
+                log.exception("Extract failed: %s", exc)
+                return error_response("extract_failed", 400)
+            for d in (IMAGES_DIR, THUMBS_DIR, CARTS_DIR):
+                d.mkdir(parents=True, exist_ok=True)
+            # Anything saved while extracting still describes the old state.
+            discard_pending()
+            load_state()
+            invalidate_catalog()
+    return ok_response()
+
+
+DEFAULT_PING_BODY = orjson.dumps({"ok": True, "greeting": "Привет, друг!"})
 
 
 @app.route("/api/ping", methods=["POST"])
 def api_ping() -> Any:
-    payload = request.get_json(silent=True) or {}
+    raw = request.get_data(cache=False)
+    # Pings almost never carry a name; answer those without parsing or encoding.
+    if not raw or raw == b"{}":
+        return app.response_class(DEFAULT_PING_BODY, mimetype="application/json")
+    payload = parse_json(raw)
     name = str(payload.get("name") or "друг").strip()
     return jsonify({"ok": True, "greeting": f"Привет, {name}!"})
 
 
 @app.route("/api/status", methods=["POST"])
 def api_status() -> Any:
-    body = request.get_json(force=True, silent=True) or {}
+    body = read_json()
     user_id = body.get("user_id")
     try:
         uid = int(user_id)
     except Exception:
         return jsonify({"ok": True, "banned": False, "mode": admin_mode()})
-    banned = is_banned(uid)
-    reason = ""
-    if banned:
-        match = next((b for b in bans if b.get("user_id") == uid), None)
-        reason = (match or {}).get("reason") or ""
+    match = bans_by_uid.get(uid)
+    banned = match is not None
+    reason = (match or {}).get("reason") or ""
     return jsonify({"ok": True, "banned": banned, "reason": reason, "mode": admin_mode()})
 
 
-def handle_update(update: Update) -> None:
+async def handle_update(update: Update) -> None:
     if not update.message:
         return
     chat_id = update.message.chat.id
     if update.message.web_app_data:
         payload = update.message.web_app_data.data
         log_event("web_app_data", user_id=chat_id, payload={"raw": payload})
-        send_sync(chat_id, f"Спасибо, получил: {payload}")
+        await send_message(chat_id, f"Спасибо, получил: {payload}")
         return
     text = update.message.text or ""
     if text.startswith("/start"):
-        buttons = [InlineKeyboardButton(text="Открыть магазин", web_app=WebAppInfo(url=WEBAPP_URL))]
-        if ADMIN_CHAT_ID and chat_id == ADMIN_CHAT_ID:
-            buttons.append(InlineKeyboardButton(text="Админ-панель", url=resolve_admin_url()))
-        kb = InlineKeyboardMarkup([buttons])
-        send_sync(chat_id, "Нажми кнопку, чтобы открыть мини-приложение.", reply_markup=kb)
+        kb = ADMIN_KB if ADMIN_CHAT_ID and chat_id == ADMIN_CHAT_ID else USER_KB
+        await send_message(chat_id, START_TEXT, reply_markup=kb)
     else:
-        send_sync(chat_id, "Отправь /start, чтобы открыть мини-приложение.")
+        await send_message(chat_id, HINT_TEXT)
+
+
+async def process_update(update: Update) -> None:
+    # Nothing awaits this task, so failures can only be logged here.
+    try:
+        await handle_update(update)
+    except Exception as exc:
+        log.exception("Handle update failed: %s", exc)
 
 
 @app.route("/telegram/webhook", methods=["POST"])
 def telegram_webhook() -> Any:
     verify_secret()
-    data = request.get_json(force=True, silent=True)
+    if request.content_length and request.content_length > WEBHOOK_MAX_BODY:
+        abort(413)
+    # Chunked bodies carry no Content-Length, so the stream itself is cut off past the limit.
+    raw = b""
+    while len(raw) <= WEBHOOK_MAX_BODY:
+        chunk = request.stream.read(WEBHOOK_MAX_BODY + 1 - len(raw))
+        if not chunk:
+            break
+        raw += chunk
+    if len(raw) > WEBHOOK_MAX_BODY:
+        abort(413)
+    data = parse_json(raw)
     if not data:
         return jsonify({"ok": False, "description": "empty body"})
     update = Update.de_json(data, bot)
-    try:
-        handle_update(update)
-    except Exception as exc:
-        log.exception("Handle update failed: %s", exc)
-        return jsonify({"ok": False})
-    return jsonify({"ok": True})
+    # Telegram only waits for the 200; the reply is sent from the bot loop afterwards.
+    asyncio.run_coroutine_threadsafe(process_update(update), loop)
+    return ok_response()
+
+
+# Last, once everything the resubmitted image jobs call is defined.
+load_state()
 
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
-    app.run(host="0.0.0.0", port=port, debug=True)
+    # Development only; production runs under gunicorn (see gunicorn.conf.py).
+    app.run(host="0.0.0.0", port=port, debug=bool(os.environ.get("DEBUG")), threaded=True)
@@ -0,0 +1,8 @@
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+# Catalog, carts and logs live in process memory, so scale with threads rather than workers.
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "8"))
+timeout = 60